@@ -1,39 +1,79 @@
-from OpenSSL import crypto
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+import datetime
 import os
 
-def create_cert():
+CERT_PATH = "certs/server.crt"
+KEY_PATH = "certs/server.key"
+RENEW_BEFORE_DAYS = 30
+
+def cert_expiry(cert):
+    # not_valid_after_utc only exists on newer cryptography releases
+    expiry = getattr(cert, "not_valid_after_utc", None)
+    if expiry is None:
+        expiry = cert.not_valid_after.replace(tzinfo=datetime.timezone.utc)
+    return expiry
+
+def cert_is_current():
+    if not (os.path.exists(CERT_PATH) and os.path.exists(KEY_PATH)):
+        return False
+    try:
+        with open(CERT_PATH, "rb") as f:
+            cert = x509.load_pem_x509_certificate(f.read())
+    except ValueError:
+        return False
+    renew_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=RENEW_BEFORE_DAYS)
+    return cert_expiry(cert) > renew_at
+
+def create_cert(force=False):
+    # keep the existing cert unless it is missing or close to expiry
+    if not force and cert_is_current():
+        print(f"Certificate still valid: {CERT_PATH}")
+        return
+
     # makes certs directory if it doesn't exist
     if not os.path.exists('certs'):
         os.makedirs('certs')
-        
-    # key pair
-    k = crypto.PKey()
-    k.generate_key(crypto.TYPE_RSA, 2048)
-    
+
+    # key pair (P-256: fast to generate and supported by every TLS client)
+    k = ec.generate_private_key(ec.SECP256R1())
+
     # self-signed cert
-    cert = crypto.X509()
-    cert.get_subject().C = "US"
-    cert.get_subject().ST = "State"
-    cert.get_subject().L = "City"
-    cert.get_subject().O = "Bus Ticketing"
-    cert.get_subject().CN = "localhost"
-    cert.set_serial_number(1000)
-    cert.gmtime_adj_notBefore(0)
-    cert.gmtime_adj_notAfter(10*365*24*60*60) 
-    cert.set_issuer(cert.get_subject())
-    cert.set_pubkey(k)
-    cert.sign(k, 'sha256')
-    
+    subject = x509.Name([
+        x509.NameAttribute(NameOID.COUNTRY_NAME, "US"),
+        x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "State"),
+        x509.NameAttribute(NameOID.LOCALITY_NAME, "City"),
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, "Bus Ticketing"),
+        x509.NameAttribute(NameOID.COMMON_NAME, "localhost"),
+    ])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(subject)
+        .public_key(k.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=10*365))
+        .sign(k, hashes.SHA256())
+    )
+
     # certificate
-    with open("certs/server.crt", "wb") as f:
-        f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
-        
+    with open(CERT_PATH, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+
     # private key
-    with open("certs/server.key", "wb") as f:
-        f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, k))
-        
-    print("Certificate generated: certs/server.crt")
-    print("Private key generated: certs/server.key")
+    with open(KEY_PATH, "wb") as f:
+        f.write(k.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption()
+        ))
+
+    print(f"Certificate generated: {CERT_PATH}")
+    print(f"Private key generated: {KEY_PATH}")
 
 if __name__ == "__main__":
     create_cert()
@@ -2,26 +2,47 @@ import os
 import sys
 import json
 import time
+import atexit
 import logging
+import logging.handlers
 import datetime
 import base64
+import decimal
 import hashlib
-from flask import Flask, request, jsonify
+import queue
+import threading
+from contextlib import closing, contextmanager
+import orjson
+from cachetools import TTLCache
+from flask import Flask, Response, g, request, jsonify
+from flask.json.provider import JSONProvider
 import mysql.connector
-from mysql.connector import Error
+from mysql.connector import Error, InterfaceError, OperationalError, PoolError, errorcode, pooling
+from cryptography.exceptions import InvalidTag
+try:
+    import redis
+except ImportError:
+    redis = None
 from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+# logging setup: request threads only enqueue records, a listener thread does the writes
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_file_handler = logging.FileHandler("server.log")
+log_file_handler.setFormatter(log_formatter)
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(log_formatter)
 
-# logging setup
+log_queue = queue.Queue(-1)
+log_queue_handler = logging.handlers.QueueHandler(log_queue)
+log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("server.log"),
-        logging.StreamHandler()
-    ]
+    handlers=[log_queue_handler]
 )
+log_listener = logging.handlers.QueueListener(log_queue, log_file_handler, log_stream_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger('bus_server')
 
 # encryption configuration
@@ -34,13 +55,8 @@ def generate_encryption_key():
             return key_file.read()
     else:
         password = b"server_secure_password"  # change for prod
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=SALT,
-            iterations=100000,
-        )
-        key = base64.urlsafe_b64encode(kdf.derive(password))
+        # hashlib's openssl-backed pbkdf2; same output as the old PBKDF2HMAC derivation
+        key = base64.urlsafe_b64encode(hashlib.pbkdf2_hmac("sha256", password, SALT, 100000, 32))
         with open(ENCRYPTION_KEY_FILE, 'wb') as key_file:
             key_file.write(key)
         return key
@@ -48,7 +64,9 @@ def generate_encryption_key():
 # initialize encryption
 try:
     encryption_key = generate_encryption_key()
-    cipher = Fernet(encryption_key)
+    # aes-gcm on the raw 32-byte key; fernet is only kept to read rows written before the switch
+    aead = AESGCM(base64.urlsafe_b64decode(encryption_key))
+    legacy_cipher = Fernet(encryption_key)
     ENCRYPTION_ENABLED = True
     print("Data encryption enabled")
 except Exception as e:
@@ -56,7 +74,21 @@ except Exception as e:
     print("Data will be stored unencrypted")
     ENCRYPTION_ENABLED = False
 
+# json encoding/decoding through orjson for every request and response
+def json_default(obj):
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=json_default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # database configuration
 DB_CONFIG = {
@@ -66,223 +98,499 @@ DB_CONFIG = {
     'database': 'bus_system'
 }
 
+# bump whenever the tables below change so the next start rebuilds them
+SCHEMA_VERSION = 3
+
+# connection pool, sized to match the server's worker threads (mysql-connector caps it at 32)
+DB_POOL_SIZE = min(int(os.getenv("DB_POOL_SIZE", "25")), pooling.CNX_POOL_MAXSIZE)
+# how long a request waits for a free pooled connection before giving up
+DB_POOL_WAIT = 2.0
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+# short-lived balance cache, filled on reads and invalidated on every balance change
+BALANCE_CACHE_SIZE = 50000
+BALANCE_CACHE_TTL = 2.0
+_balance_cache = TTLCache(BALANCE_CACHE_SIZE, BALANCE_CACHE_TTL)
+_balance_cache_lock = threading.RLock()
+
+# optional redis balance cache shared by every worker process; mysql stays the source of truth.
+# writes delete the key and only reads fill it, with the same short ttl as the local cache,
+# so a lost or out-of-order update can't pin a stale balance
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_BALANCE_TTL_MS = int(BALANCE_CACHE_TTL * 1000)
+redis_client = redis.Redis.from_url(REDIS_URL, socket_timeout=0.1) if redis and REDIS_URL else None
+
+# terminals seen recently skip the db check; their last_seen bumps are batched
+TERMINAL_CACHE_SIZE = 1024
+TERMINAL_CACHE_TTL = 60.0
+TERMINAL_SEEN_FLUSH_INTERVAL = 1.0
+_known_terminals = TTLCache(TERMINAL_CACHE_SIZE, TERMINAL_CACHE_TTL)
+_known_terminals_lock = threading.Lock()
+_terminal_seen_queue = queue.Queue()
+
+# after-the-fact transaction records are queued and inserted in batches
+TRANSACTION_BATCH_SIZE = 256
+TRANSACTION_FLUSH_INTERVAL = 0.05
+_transaction_queue = queue.SimpleQueue()
+
+# client_tx_ids synced recently; replays are answered without touching the db
+SEEN_TX_CACHE_SIZE = 100000
+SEEN_TX_CACHE_TTL = 3600
+_seen_transactions = TTLCache(SEEN_TX_CACHE_SIZE, SEEN_TX_CACHE_TTL)
+_seen_transactions_lock = threading.Lock()
+
+INSERT_TRANSACTION_SQL = """
+    INSERT INTO transactions 
+    (account_id, amount, balance_before, balance_after, transaction_type, terminal_id, client_tx_id) 
+    VALUES (%s, %s, %s, %s, %s, %s, %s)"""
+
+# synced rows carry a client_tx_id; a replay hits the unique key and is skipped (rowcount 0).
+# not INSERT IGNORE, which would also skip rows failing a foreign key and report them as duplicates
+INSERT_SYNCED_TRANSACTION_SQL = INSERT_TRANSACTION_SQL + " ON DUPLICATE KEY UPDATE id = id"
+
+# registers a card only if it is new; rowcount tells the two cases apart
+INSERT_CARD_SQL = "INSERT IGNORE INTO cards (id, balance) VALUES (%s, %s)"
+
+# balances are held as integer cents; dollars only appear at the api boundary
+DEFAULT_BALANCE_CENTS = 5000
+
+def to_cents(amount):
+    return int(round(float(amount) * 100))
+
+def from_cents(cents):
+    return cents / 100
+
 # encryption functions
-def encrypt_data(data):
-    if not ENCRYPTION_ENABLED:
-        return data
-    if data is None:
-        return None
-    if isinstance(data, (int, float)):
-        data = str(data)
-    if isinstance(data, str):
-        return cipher.encrypt(data.encode()).decode()
-    return data
-
-def decrypt_data(data):
-    if not ENCRYPTION_ENABLED or data is None:
-        return data
-    if isinstance(data, str):
+# base64 ciphertext from before the transaction columns held raw bytes (aes-gcm, or fernet before that)
+def decrypt_text(token):
+    try:
+        raw = base64.b64decode(token, validate=True)
+        return aead.decrypt(raw[:12], raw[12:], None).decode()
+    except (ValueError, InvalidTag):
+        # fernet tokens are urlsafe base64 and fail one of the checks above
+        return legacy_cipher.decrypt(token.encode()).decode()
+
+# transaction columns are VARBINARY and hold nonce + ciphertext + tag without base64
+def encrypt_field(text):
+    nonce = os.urandom(12)
+    return nonce + aead.encrypt(nonce, text.encode(), None)
+
+def decrypt_field(value):
+    value = bytes(value)
+    try:
+        return aead.decrypt(value[:12], value[12:], None).decode()
+    except InvalidTag:
+        # rows written before the switch to raw bytes hold base64 text
+        return decrypt_text(value.decode())
+
+# batch versions for the transaction fields: one call per row instead of one per field
+def encrypt_fields(values):
+    return [encrypt_field(v) if v is not None else None for v in values]
+
+def decrypt_fields(values):
+    decrypted = []
+    for v in values:
         try:
-            return cipher.decrypt(data.encode()).decode()
+            decrypted.append(decrypt_field(v) if v is not None else None)
         except Exception:
-            return data
-    return data
+            # hand back undecryptable values as base64 so they still serialise
+            decrypted.append(base64.b64encode(bytes(v)).decode())
+    return decrypted
+
+def decode_fields(values):
+    return [bytes(v).decode() if v is not None else None for v in values]
+
+# picked once at startup so the hot path never re-checks ENCRYPTION_ENABLED
+encrypt_many = encrypt_fields if ENCRYPTION_ENABLED else list
+decrypt_many = decrypt_fields if ENCRYPTION_ENABLED else decode_fields
+
+def get_db_pool():
+    # created lazily so a cold start doesn't fail at import if mysql is still coming up
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = pooling.MySQLConnectionPool(
+                    pool_name="bus",
+                    pool_size=DB_POOL_SIZE,
+                    pool_reset_session=False,
+                    **DB_CONFIG
+                )
+                logger.info(f"Created MySQL connection pool with {DB_POOL_SIZE} connections")
+    return _db_pool
 
 def get_db_connection():
+    # close() on a pooled connection hands it back to the pool
+    deadline = time.monotonic() + DB_POOL_WAIT
+    while True:
+        try:
+            return get_db_pool().get_connection()
+        except PoolError as e:
+            # the pool raises straight away when exhausted, so wait briefly for a release
+            if time.monotonic() >= deadline:
+                logger.error(f"Database connection error: {e}")
+                return None
+            time.sleep(0.005)
+        except Error as e:
+            logger.error(f"Database connection error: {e}")
+            return None
+
+class StatementCache:
+    # cursor-like front for one prepared cursor per sql string, so each statement is
+    # prepared once per connection instead of on every switch between statements
+    def __init__(self, conn):
+        self.conn = conn
+        self.connection_id = conn.connection_id
+        self.cursors = {}
+        self.last = None
+
+    def execute(self, operation, params=()):
+        cursor = self.cursors.get(operation)
+        if cursor is None:
+            cursor = self.cursors[operation] = self.conn.cursor(prepared=True)
+        self.last = cursor
+        try:
+            cursor.execute(operation, params)
+        except Error:
+            # the statement handles may be gone with the server session; prepare afresh next time
+            self.clear()
+            raise
+
+    def clear(self):
+        for cursor in self.cursors.values():
+            try:
+                cursor.close()
+            except Error:
+                pass
+        self.cursors.clear()
+
+    def fetchall(self):
+        return self.last.fetchall()
+
+    @property
+    def rowcount(self):
+        return self.last.rowcount
+
+def get_statement_cache(conn):
+    # kept on the raw connection behind the pool's wrapper, so the cursors always belong to
+    # the connection in hand. a changed connection id means a reconnect, but an unchanged one
+    # proves nothing (ids restart after a mysql restart), so execute() also drops them on errors
+    cnx = conn._cnx
+    statements = getattr(cnx, "statement_cache", None)
+    if statements is None or statements.connection_id != conn.connection_id:
+        statements = cnx.statement_cache = StatementCache(conn)
+    # the pool hands out a new wrapper around the same connection each time
+    statements.conn = conn
+    return statements
+
+# one pooled connection and its prepared statements per request, acquired on first use
+def get_request_db():
+    if 'db_conn' not in g:
+        conn = get_db_connection()
+        if not conn:
+            return None, None
+        g.db_conn = conn
+        g.db_cursor = get_statement_cache(conn)
+    return g.db_conn, g.db_cursor
+
+@app.teardown_request
+def release_request_db(exc):
+    conn = g.pop('db_conn', None)
+    g.pop('db_cursor', None)
+    if conn is None:
+        return
+
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        return conn
+        # pool_reset_session is off, so don't hand back an open transaction
+        if conn.in_transaction:
+            conn.rollback()
     except Error as e:
-        logger.error(f"Database connection error: {e}")
-        return None
+        logger.error(f"Error releasing request connection: {e}")
+    finally:
+        conn.close()
 
-def init_database():
-    logger.info("Initializing MySQL database...")
+@contextmanager
+def db_cursor(**cursor_args):
+    # pooled connection for work outside a request (startup, background writers)
+    conn = get_db_connection()
+    if not conn:
+        raise Error("Could not connect to database")
 
+    cursor = conn.cursor(**cursor_args)
     try:
-        conn = get_db_connection()
-        if not conn:
-            logger.error("Could not connect to MySQL database")
-            return False
-            
-        cursor = conn.cursor()
-        
-        # drop existing tables to recreate with correct types
+        yield conn, cursor
+    finally:
         try:
-            cursor.execute("DROP TABLE IF EXISTS transactions")
-            cursor.execute("DROP TABLE IF EXISTS cards")
-            cursor.execute("DROP TABLE IF EXISTS terminals")
-        except Exception as e:
-            logger.warning(f"Error dropping tables (this is normal for first run): {e}")
+            cursor.close()
+        except Error:
+            pass
+        conn.close()
+
+def fetch_single_row(cursor):
+    # fetchall drains the result so the shared cursor is ready for its next statement
+    rows = cursor.fetchall()
+    return rows[0] if rows else None
+
+def get_schema_version(cursor):
+    # the meta table is missing on a fresh database
+    try:
+        cursor.execute("SELECT value FROM meta WHERE k = 'schema_version'")
+        row = fetch_single_row(cursor)
+    except Error:
+        return None
+    return int(row[0]) if row else None
+
+def get_existing_tables(cursor):
+    cursor.execute(
+        "SELECT table_name FROM information_schema.tables "
+        "WHERE table_schema = DATABASE() AND table_name IN ('terminals', 'cards', 'transactions')"
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+def init_database(reset=False):
+    try:
+        with db_cursor() as (conn, cursor):
+            version = None if reset else get_schema_version(cursor)
+            if version == SCHEMA_VERSION:
+                logger.info(f"MySQL schema is at version {SCHEMA_VERSION}, skipping initialization")
+                return True
+
+            # tables without a version were built before the sentinel (text balances, no client_tx_id);
+            # the statements below can't upgrade them, so don't stamp a version over them
+            if not reset and version is None:
+                existing_tables = get_existing_tables(cursor)
+                if existing_tables:
+                    logger.error(
+                        f"Found tables from an unversioned schema ({', '.join(existing_tables)}). "
+                        "Run 'python server.py --reset' to recreate them (this deletes all cards and transactions)."
+                    )
+                    return False
+
+            logger.info("Initializing MySQL database...")
+
+            # only wipe data when started with --reset
+            if reset:
+                logger.warning("Dropping all tables (--reset)")
+                cursor.execute("DROP TABLE IF EXISTS transactions")
+                cursor.execute("DROP TABLE IF EXISTS cards")
+                cursor.execute("DROP TABLE IF EXISTS terminals")
             
-        # create terminals table
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS terminals (
-            id VARCHAR(50) PRIMARY KEY,
-            last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-            is_active BOOLEAN DEFAULT TRUE,
-            pending_transactions INT DEFAULT 0
-        ) ENGINE=InnoDB;
-        """)
+            # create terminals table
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS terminals (
+                id VARCHAR(50) PRIMARY KEY,
+                last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                is_active BOOLEAN DEFAULT TRUE,
+                pending_transactions INT DEFAULT 0
+            ) ENGINE=InnoDB;
+            """)
         
-        # create cards table with text for encrypted balance
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS cards (
-            id VARCHAR(50) PRIMARY KEY,
-            balance TEXT NOT NULL,
-            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-            is_active BOOLEAN DEFAULT TRUE
-        ) ENGINE=InnoDB;
-        """)
+            # create cards table with the balance in integer cents
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS cards (
+                id VARCHAR(50) PRIMARY KEY,
+                balance BIGINT NOT NULL,
+                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                is_active BOOLEAN DEFAULT TRUE
+            ) ENGINE=InnoDB;
+            """)
         
-        # create transactions table with text for encrypted fields
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS transactions (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            account_id VARCHAR(50),
-            amount TEXT NOT NULL,
-            balance_before TEXT,
-            balance_after TEXT,
-            transaction_type TEXT,
-            terminal_id VARCHAR(50),
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            synced BOOLEAN DEFAULT TRUE,
-            FOREIGN KEY (account_id) REFERENCES cards(id) ON DELETE CASCADE,
-            FOREIGN KEY (terminal_id) REFERENCES terminals(id) ON DELETE CASCADE
-        ) ENGINE=InnoDB;
-        """)
+            # create transactions table with binary columns for encrypted fields
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS transactions (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                account_id VARCHAR(50),
+                amount VARBINARY(255) NOT NULL,
+                balance_before VARBINARY(255),
+                balance_after VARBINARY(255),
+                transaction_type VARBINARY(255),
+                terminal_id VARCHAR(50),
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                synced BOOLEAN DEFAULT TRUE,
+                client_tx_id VARCHAR(64) NULL,
+                UNIQUE KEY ux_tx_client (client_tx_id),
+                INDEX ix_tx_acct_ts_id (account_id, timestamp DESC, id DESC),
+                FOREIGN KEY (account_id) REFERENCES cards(id) ON DELETE CASCADE,
+                FOREIGN KEY (terminal_id) REFERENCES terminals(id) ON DELETE CASCADE
+            ) ENGINE=InnoDB;
+            """)
         
-        conn.commit()
-        logger.info("MySQL database initialized successfully")
-        return True
+            # tables from schema version 1 stored base64 ciphertext in TEXT columns
+            cursor.execute("""
+            ALTER TABLE transactions
+                MODIFY amount VARBINARY(255) NOT NULL,
+                MODIFY balance_before VARBINARY(255),
+                MODIFY balance_after VARBINARY(255),
+                MODIFY transaction_type VARBINARY(255)
+            """)
+
+            # before version 3 the history index left id out of the sort order,
+            # so ORDER BY timestamp DESC, id DESC needed a filesort
+            if version is not None and version < 3:
+                cursor.execute("""
+                ALTER TABLE transactions
+                    ADD INDEX ix_tx_acct_ts_id (account_id, timestamp DESC, id DESC),
+                    DROP INDEX ix_tx_acct_ts
+                """)
+
+            # record the schema version so warm starts skip the DDL above
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                k VARCHAR(64) PRIMARY KEY,
+                value VARCHAR(64) NOT NULL
+            ) ENGINE=InnoDB;
+            """)
+            cursor.execute(
+                "INSERT INTO meta (k, value) VALUES ('schema_version', %s) "
+                "ON DUPLICATE KEY UPDATE value = VALUES(value)",
+                (str(SCHEMA_VERSION),)
+            )
+
+            conn.commit()
+            logger.info("MySQL database initialized successfully")
+            return True
         
     except Error as e:
         logger.error(f"MySQL initialization error: {e}")
         return False
-    finally:
-        if conn and conn.is_connected():
-            cursor.close()
-            conn.close()
+
+def remember_terminal(terminal_id):
+    with _known_terminals_lock:
+        _known_terminals[terminal_id] = True
+
+def is_known_terminal(terminal_id):
+    with _known_terminals_lock:
+        return terminal_id in _known_terminals
 
 def ensure_terminal_exists(terminal_id):
+    if is_known_terminal(terminal_id):
+        _terminal_seen_queue.put(terminal_id)
+        return True
+
+    conn, cursor = get_request_db()
+    if not conn:
+        logger.error("Could not connect to database")
+        return False
+
     try:
-        conn = get_db_connection()
-        if not conn:
-            logger.error("Could not connect to database")
-            return False
+        cursor.execute(
+            "INSERT INTO terminals (id, last_seen) VALUES (%s, NOW()) "
+            "ON DUPLICATE KEY UPDATE last_seen = NOW()",
+            (terminal_id,)
+        )
+        conn.commit()
 
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT id FROM terminals WHERE id = %s", (terminal_id,))
-        result = cursor.fetchone()
-        
-        if not result:
-            cursor.execute(
-                "INSERT INTO terminals (id, last_seen) VALUES (%s, NOW())",
-                (terminal_id,)
-            )
-            conn.commit()
+        # rowcount is 1 for a fresh insert, 2 when an existing row was updated
+        if cursor.rowcount == 1:
             logger.info(f"Registered new terminal: {terminal_id}")
-        else:
-            cursor.execute(
-                "UPDATE terminals SET last_seen = NOW() WHERE id = %s",
-                (terminal_id,)
-            )
-            conn.commit()
         
+        remember_terminal(terminal_id)
         return True
     except Error as e:
         logger.error(f"Error in ensure_terminal_exists: {e}")
         return False
-    finally:
-        if conn and conn.is_connected():
-            cursor.close()
-            conn.close()
 
-def ensure_card_exists(card_id, initial_balance=50.0):
+def ensure_card_exists(card_id, initial_balance=DEFAULT_BALANCE_CENTS):
+    conn, cursor = get_request_db()
+    if not conn:
+        logger.error("Could not connect to database")
+        return False
+
     try:
-        conn = get_db_connection()
-        if not conn:
-            logger.error("Could not connect to database")
-            return False
+        cursor.execute(INSERT_CARD_SQL, (card_id, initial_balance))
+        conn.commit()
 
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT id FROM cards WHERE id = %s", (card_id,))
-        result = cursor.fetchone()
-        
-        if not result:
-            balance_value = encrypt_data(str(initial_balance)) if ENCRYPTION_ENABLED else str(initial_balance)
-            
-            cursor.execute(
-                "INSERT INTO cards (id, balance) VALUES (%s, %s)",
-                (card_id, balance_value)
-            )
-            conn.commit()
-            logger.info(f"Registered new card: {card_id} with balance ${initial_balance}")
-            return True
+        if cursor.rowcount == 1:
+            invalidate_card_balance(card_id)
+            logger.info(f"Registered new card: {card_id} with balance ${from_cents(initial_balance):.2f}")
         return True
     except Error as e:
         logger.error(f"Error in ensure_card_exists: {e}")
         return False
-    finally:
-        if conn and conn.is_connected():
-            cursor.close()
-            conn.close()
 
-def get_card_balance(card_id):
+def invalidate_card_balance(card_id):
+    # after a committed balance change; writing the new value instead could race another
+    # thread's change to the same card and leave the older balance cached
+    with _balance_cache_lock:
+        _balance_cache.pop(card_id, None)
+
+    if redis_client:
+        try:
+            redis_client.delete(f"card:{card_id}")
+        except redis.RedisError as e:
+            logger.warning(f"Redis balance invalidation failed: {e}")
+
+def fill_card_balance_cache(card_id, balance):
+    # after reading the balance from mysql
+    with _balance_cache_lock:
+        _balance_cache[card_id] = balance
+
+    if redis_client:
+        try:
+            redis_client.set(f"card:{card_id}", balance, px=REDIS_BALANCE_TTL_MS)
+        except redis.RedisError as e:
+            logger.warning(f"Redis balance write failed: {e}")
+
+def get_cached_card_balance(card_id):
+    with _balance_cache_lock:
+        balance = _balance_cache.get(card_id)
+    if balance is not None or not redis_client:
+        return balance
+
     try:
-        conn = get_db_connection()
-        if not conn:
-            logger.error("Could not connect to database")
-            return None
+        value = redis_client.get(f"card:{card_id}")
+    except redis.RedisError as e:
+        logger.warning(f"Redis balance read failed: {e}")
+        return None
 
-        cursor = conn.cursor()
-        
+    if value is None:
+        return None
+    balance = int(value)
+    with _balance_cache_lock:
+        _balance_cache[card_id] = balance
+    return balance
+
+def get_card_balance(card_id):
+    cached_balance = get_cached_card_balance(card_id)
+    if cached_balance is not None:
+        return cached_balance
+
+    conn, cursor = get_request_db()
+    if not conn:
+        logger.error("Could not connect to database")
+        return None
+
+    try:
         cursor.execute("SELECT balance FROM cards WHERE id = %s", (card_id,))
-        result = cursor.fetchone()
+        result = fetch_single_row(cursor)
         
         if result:
-            encrypted_balance = result[0]
-            
-            if ENCRYPTION_ENABLED:
-                try:
-                    decrypted_balance = decrypt_data(encrypted_balance)
-                    return float(decrypted_balance)
-                except Exception as e:
-                    logger.error(f"Error decrypting balance: {e}")
-                    return float(encrypted_balance)
-            else:
-                return float(encrypted_balance)
+            balance = int(result[0])
+            fill_card_balance_cache(card_id, balance)
+            return balance
         else:
             return None
     except Error as e:
         logger.error(f"Error in get_card_balance: {e}")
         return None
-    finally:
-        if conn and conn.is_connected():
-            cursor.close()
-            conn.close()
 
 def update_card_balance(card_id, new_balance):
-    try:
-        conn = get_db_connection()
-        if not conn:
-            logger.error("Could not connect to database")
-            return False
+    conn, cursor = get_request_db()
+    if not conn:
+        logger.error("Could not connect to database")
+        return False
 
-        cursor = conn.cursor()
-        
-        balance_value = encrypt_data(str(new_balance)) if ENCRYPTION_ENABLED else str(new_balance)
-        
+    try:
         cursor.execute(
             "UPDATE cards SET balance = %s WHERE id = %s",
-            (balance_value, card_id)
+            (new_balance, card_id)
         )
         conn.commit()
         
         if cursor.rowcount > 0:
-            logger.info(f"Updated balance for card {card_id}: ${new_balance}")
+            invalidate_card_balance(card_id)
+            logger.debug(f"Updated balance for card {card_id}: ${from_cents(new_balance):.2f}")
             return True
         else:
             logger.warning(f"No card found with ID {card_id}")
@@ -290,77 +598,295 @@ def update_card_balance(card_id, new_balance):
     except Error as e:
         logger.error(f"Error in update_card_balance: {e}")
         return False
-    finally:
-        if conn and conn.is_connected():
-            cursor.close()
-            conn.close()
 
-def record_transaction(card_id, amount, balance_before, balance_after, transaction_type, terminal_id):
-    try:
-        conn = get_db_connection()
-        if not conn:
-            logger.error("Could not connect to database")
-            return False
+def is_seen_transaction(client_tx_id):
+    with _seen_transactions_lock:
+        return client_tx_id in _seen_transactions
+
+def remember_transaction(client_tx_id):
+    with _seen_transactions_lock:
+        _seen_transactions[client_tx_id] = True
+
+def record_transaction(card_id, amount, balance_before, balance_after, transaction_type, terminal_id, client_tx_id=None):
+    # queued for the background writer; the row is committed within TRANSACTION_FLUSH_INTERVAL
+    _transaction_queue.put(transaction_row(card_id, amount, balance_before, balance_after, transaction_type, terminal_id, client_tx_id))
+    logger.debug(f"Queued transaction: card={card_id}, amount={from_cents(amount)}, type={transaction_type}")
+    return True
 
+# errors that leave nothing committed and usually pass on a retry; the connector reports
+# deadlocks, lock wait timeouts and "server has gone away" as plain DatabaseError
+TRANSIENT_DB_ERRORS = {
+    errorcode.ER_LOCK_DEADLOCK,
+    errorcode.ER_LOCK_WAIT_TIMEOUT,
+    errorcode.CR_SERVER_GONE_ERROR,
+    errorcode.CR_SERVER_LOST,
+}
+
+def is_transient_db_error(error):
+    return isinstance(error, (OperationalError, InterfaceError)) or error.errno in TRANSIENT_DB_ERRORS
+
+def requeue_transactions(rows):
+    for row in rows:
+        _transaction_queue.put(row)
+
+def flush_transactions(rows):
+    conn = get_db_connection()
+    if not conn:
+        logger.error(f"Could not connect to database, requeueing {len(rows)} transactions")
+        requeue_transactions(rows)
+        return False
+
+    try:
+        # plain cursor: executemany() folds the rows into one multi-row INSERT
         cursor = conn.cursor()
-        
-        # encrypt sensitive data if encryption is enabled
-        amount_value = encrypt_data(str(amount)) if ENCRYPTION_ENABLED else str(amount)
-        balance_before_value = encrypt_data(str(balance_before)) if ENCRYPTION_ENABLED else str(balance_before)
-        balance_after_value = encrypt_data(str(balance_after)) if ENCRYPTION_ENABLED else str(balance_after)
-        transaction_type_value = encrypt_data(transaction_type) if ENCRYPTION_ENABLED else transaction_type
-        
-        cursor.execute("""
-        INSERT INTO transactions 
-        (account_id, amount, balance_before, balance_after, transaction_type, terminal_id) 
-        VALUES (%s, %s, %s, %s, %s, %s)""", 
-        (card_id, amount_value, balance_before_value, balance_after_value, transaction_type_value, terminal_id))
-        
+        cursor.executemany(INSERT_SYNCED_TRANSACTION_SQL, rows)
         conn.commit()
-        logger.info(f"Recorded transaction: card={card_id}, amount={amount}, type={transaction_type}")
+        cursor.close()
+        # only committed rows count as seen, so a replay of a lost row is written again
+        for row in rows:
+            if row[6]:
+                remember_transaction(row[6])
         return True
     except Error as e:
-        logger.error(f"Error in record_transaction: {e}")
-        return False
+        try:
+            conn.rollback()
+        except Error:
+            pass
+        if is_transient_db_error(e):
+            logger.error(f"Error writing {len(rows)} queued transactions, requeueing: {e}")
+            requeue_transactions(rows)
+            return False
+        logger.error(f"Error writing {len(rows)} queued transactions: {e}")
+        if len(rows) == 1:
+            logger.error(f"Dropped transaction for card {rows[0][0]} from terminal {rows[0][5]}")
+            return False
     finally:
-        if conn and conn.is_connected():
-            cursor.close()
-            conn.close()
+        conn.close()
+
+    # one bad row (e.g. an unknown terminal) fails the whole insert; write the rest one by one
+    for row in rows:
+        flush_transactions([row])
+    return False
+
+def transaction_writer():
+    while True:
+        rows = [_transaction_queue.get()]
+        deadline = time.time() + TRANSACTION_FLUSH_INTERVAL
+
+        while len(rows) < TRANSACTION_BATCH_SIZE:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                rows.append(_transaction_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        if not flush_transactions(rows):
+            time.sleep(1)
+
+def flush_pending_transactions():
+    rows = []
+    while True:
+        try:
+            rows.append(_transaction_queue.get_nowait())
+        except queue.Empty:
+            break
+
+    for i in range(0, len(rows), TRANSACTION_BATCH_SIZE):
+        flush_transactions(rows[i:i + TRANSACTION_BATCH_SIZE])
+
+def start_transaction_writer():
+    thread = threading.Thread(target=transaction_writer, daemon=True)
+    thread.start()
+    atexit.register(flush_pending_transactions)
+    logger.info("Transaction writer thread started")
+
+# single-transaction paths: one connection, one commit per payment, topup or sync
+def lock_card_balance(cursor, card_id, initial_balance=DEFAULT_BALANCE_CENTS):
+    cursor.execute("SELECT balance FROM cards WHERE id = %s FOR UPDATE", (card_id,))
+    result = fetch_single_row(cursor)
+
+    if result:
+        return int(result[0])
+
+    cursor.execute(
+        "INSERT INTO cards (id, balance) VALUES (%s, %s)",
+        (card_id, initial_balance)
+    )
+    logger.info(f"Registered new card: {card_id} with balance ${from_cents(initial_balance):.2f}")
+    return initial_balance
+
+def write_card_balance(cursor, card_id, new_balance):
+    cursor.execute(
+        "UPDATE cards SET balance = %s WHERE id = %s",
+        (new_balance, card_id)
+    )
+    logger.debug(f"Updated balance for card {card_id}: ${from_cents(new_balance):.2f}")
+
+def transaction_row(card_id, amount, balance_before, balance_after, transaction_type, terminal_id, client_tx_id=None):
+    # encrypt sensitive data if encryption is enabled
+    amount_value, balance_before_value, balance_after_value, transaction_type_value = encrypt_many(
+        (str(amount), str(balance_before), str(balance_after), transaction_type)
+    )
+    return (card_id, amount_value, balance_before_value, balance_after_value, transaction_type_value, terminal_id, client_tx_id)
+
+def insert_transaction(cursor, card_id, amount, balance_before, balance_after, transaction_type, terminal_id, client_tx_id=None):
+    # returns False when client_tx_id was already recorded
+    cursor.execute(
+        INSERT_SYNCED_TRANSACTION_SQL if client_tx_id else INSERT_TRANSACTION_SQL,
+        transaction_row(card_id, amount, balance_before, balance_after, transaction_type, terminal_id, client_tx_id)
+    )
+    if cursor.rowcount == 0:
+        return False
+    logger.debug(f"Recorded transaction: card={card_id}, amount={from_cents(amount)}, type={transaction_type}")
+    return True
+
+def apply_card_transaction(conn, cursor, card_id, amount, transaction_type, terminal_id):
+    # returns (balance_before, balance_after); balance_after is None when funds are insufficient
+    try:
+        # funds check and balance change in one statement, so concurrent payments can't overdraw
+        cursor.execute(
+            "UPDATE cards SET balance = balance + %s WHERE id = %s AND balance + %s >= 0",
+            (amount, card_id, amount)
+        )
+
+        if cursor.rowcount > 0:
+            # the row stays locked until commit, so this reads our own update
+            cursor.execute("SELECT balance FROM cards WHERE id = %s", (card_id,))
+            new_balance = int(fetch_single_row(cursor)[0])
+            current_balance = new_balance - amount
+            logger.debug(f"Updated balance for card {card_id}: ${from_cents(new_balance):.2f}")
+        else:
+            # unknown card or insufficient funds; unknown cards are registered here
+            current_balance = lock_card_balance(cursor, card_id)
+            new_balance = current_balance + amount
+
+            if new_balance < 0:
+                conn.commit()
+                invalidate_card_balance(card_id)
+                return current_balance, None
+
+            write_card_balance(cursor, card_id, new_balance)
+
+        insert_transaction(cursor, card_id, amount, current_balance, new_balance, transaction_type, terminal_id)
+        conn.commit()
+        invalidate_card_balance(card_id)
+        return current_balance, new_balance
+    except Error:
+        conn.rollback()
+        raise
+
+def sync_card_transaction(conn, cursor, card_id, amount, balance_before, balance_after, transaction_type, terminal_id, client_tx_id=None):
+    # returns False if client_tx_id was already synced; the balance change is rolled back
+    try:
+        current_balance = lock_card_balance(cursor, card_id)
+
+        if balance_before is None or balance_after is None:
+            if balance_before is None:
+                balance_before = current_balance - amount
+
+            if balance_after is None:
+                balance_after = current_balance
+
+            write_card_balance(cursor, card_id, balance_after)
+            current_balance = balance_after
+
+        if not insert_transaction(cursor, card_id, amount, balance_before, balance_after, transaction_type, terminal_id, client_tx_id):
+            conn.rollback()
+            return False
+
+        conn.commit()
+        invalidate_card_balance(card_id)
+        return True
+    except Error:
+        conn.rollback()
+        raise
+
+def terminal_last_seen_writer():
+    while True:
+        terminal_ids = {_terminal_seen_queue.get()}
+        time.sleep(TERMINAL_SEEN_FLUSH_INTERVAL)
+
+        while True:
+            try:
+                terminal_ids.add(_terminal_seen_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            with db_cursor() as (conn, cursor):
+                placeholders = ", ".join(["%s"] * len(terminal_ids))
+                cursor.execute(
+                    f"UPDATE terminals SET last_seen = NOW() WHERE id IN ({placeholders})",
+                    tuple(terminal_ids)
+                )
+                conn.commit()
+        except Error as e:
+            logger.error(f"Error updating terminal last_seen: {e}")
+
+def start_terminal_last_seen_writer():
+    thread = threading.Thread(target=terminal_last_seen_writer, daemon=True)
+    thread.start()
+    logger.info("Terminal last_seen writer thread started")
+
+start_terminal_last_seen_writer()
+start_transaction_writer()
 
 # api hell
+# request parsing and the common error bodies, prebuilt so handlers skip jsonify
+ERR_TERMINAL_ID_REQUIRED = b'{"error":"terminal_id is required"}'
+ERR_UID_REQUIRED = b'{"error":"uid is required"}'
+ERR_UID_FARE_REQUIRED = b'{"error":"uid and fare are required"}'
+ERR_UID_AMOUNT_REQUIRED = b'{"error":"uid and amount are required"}'
+ERR_DB_CONNECTION = b'{"error":"Database connection failed"}'
+ERR_TRANSACTIONS_REQUIRED = b'{"error":"transactions list is required"}'
+
+def error_response(body, status=400):
+    return Response(body, status=status, mimetype='application/json')
+
+def load_json_body():
+    # parsed once with orjson; malformed or non-object bodies are treated as missing
+    try:
+        data = orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
+# health body is rebuilt at most once per HEALTH_CACHE_TTL seconds
+HEALTH_CACHE_TTL = 1.0
+_health_cache = (0.0, b"")
+
 @app.route('/health', methods=['GET'])
 def health_check():
-    return jsonify({"status": "ok", "timestamp": datetime.datetime.now().isoformat()})
+    global _health_cache
+    now = time.time()
+    if now - _health_cache[0] > HEALTH_CACHE_TTL:
+        timestamp = datetime.datetime.fromtimestamp(now).isoformat()
+        _health_cache = (now, b'{"status":"ok","timestamp":"' + timestamp.encode() + b'"}')
+    return Response(_health_cache[1], mimetype='application/json')
 
 @app.route('/terminal_heartbeat', methods=['POST'])
 def terminal_heartbeat():
-    data = request.json
+    data = load_json_body()
     
     if not data or 'terminal_id' not in data:
-        return jsonify({"error": "terminal_id is required"}), 400
+        return error_response(ERR_TERMINAL_ID_REQUIRED)
         
     terminal_id = data['terminal_id']
     pending_count = data.get('pending_transactions', 0)
     
     try:
-        conn = get_db_connection()
+        conn, cursor = get_request_db()
         if conn:
-            cursor = conn.cursor()
-            
             cursor.execute(
-                "UPDATE terminals SET last_seen = NOW(), pending_transactions = %s WHERE id = %s",
-                (pending_count, terminal_id)
+                "INSERT INTO terminals (id, last_seen, pending_transactions) VALUES (%s, NOW(), %s) "
+                "ON DUPLICATE KEY UPDATE last_seen = NOW(), pending_transactions = %s",
+                (terminal_id, pending_count, pending_count)
             )
             
-            if cursor.rowcount == 0:
-                cursor.execute(
-                    "INSERT INTO terminals (id, last_seen, pending_transactions) VALUES (%s, NOW(), %s)",
-                    (terminal_id, pending_count)
-                )
-            
             conn.commit()
-            cursor.close()
-            conn.close()
+            remember_terminal(terminal_id)
     except Exception as e:
         logger.error(f"Error updating terminal heartbeat: {e}")
     
@@ -373,19 +899,19 @@ def terminal_heartbeat():
 
 @app.route('/register_card', methods=['POST'])
 def register_card():
-    data = request.json
+    data = load_json_body()
 
     if not data or 'uid' not in data:
-        return jsonify({"error": "uid is required"}), 400
+        return error_response(ERR_UID_REQUIRED)
 
     card_id = data['uid']
-    initial_balance = data.get('initial_balance', 50.0)
+    initial_balance = data.get('initial_balance', from_cents(DEFAULT_BALANCE_CENTS))
     terminal_id = data.get('terminal_id')
 
     if terminal_id:
         ensure_terminal_exists(terminal_id)
 
-    if ensure_card_exists(card_id, initial_balance):
+    if ensure_card_exists(card_id, to_cents(initial_balance)):
         return jsonify({
             "status": "success",
             "uid": card_id,
@@ -407,7 +933,7 @@ def api_get_card_balance(card_id):
         return jsonify({
             "status": "success",
             "uid": card_id,
-            "balance": balance
+            "balance": from_cents(balance)
         })
     else:
         # if card doesn't exist it gets a default balance
@@ -415,7 +941,7 @@ def api_get_card_balance(card_id):
             return jsonify({
                 "status": "success",
                 "uid": card_id,
-                "balance": 50.0,
+                "balance": from_cents(DEFAULT_BALANCE_CENTS),
                 "message": "New card created with default balance"
             })
         else:
@@ -423,10 +949,10 @@ def api_get_card_balance(card_id):
 
 @app.route('/process_payment', methods=['POST'])
 def process_payment():
-    data = request.json
+    data = load_json_body()
 
     if not data or 'uid' not in data or 'fare' not in data:
-        return jsonify({"error": "uid and fare are required"}), 400
+        return error_response(ERR_UID_FARE_REQUIRED)
 
     card_id = data['uid']
     fare_amount = float(data['fare'])
@@ -435,45 +961,37 @@ def process_payment():
     if terminal_id:
         ensure_terminal_exists(terminal_id)
 
-    if not ensure_card_exists(card_id):
-        return jsonify({"error": "Card registration failed"}), 500
+    conn, cursor = get_request_db()
+    if not conn:
+        return error_response(ERR_DB_CONNECTION, 500)
 
-    current_balance = get_card_balance(card_id)
+    try:
+        current_balance, new_balance = apply_card_transaction(conn, cursor, card_id, -to_cents(fare_amount), "payment", terminal_id)
+    except Error as e:
+        logger.error(f"Error in process_payment: {e}")
+        return jsonify({"error": "Failed to process payment"}), 500
 
-    if current_balance < fare_amount:
+    if new_balance is None:
         return jsonify({
             "status": "error",
             "message": "Insufficient funds",
-            "balance": current_balance
+            "balance": from_cents(current_balance)
         }), 400
 
-    new_balance = current_balance - fare_amount
-    if update_card_balance(card_id, new_balance):
-        record_transaction(
-            card_id, 
-            -fare_amount, 
-            current_balance,
-            new_balance,
-            "payment", 
-            terminal_id
-        )
-        
-        return jsonify({
-            "status": "success",
-            "uid": card_id,
-            "prior_balance": current_balance,
-            "fare_amount": fare_amount,
-            "new_balance": new_balance
-        })
-    else:
-        return jsonify({"error": "Failed to process payment"}), 500
+    return jsonify({
+        "status": "success",
+        "uid": card_id,
+        "prior_balance": from_cents(current_balance),
+        "fare_amount": fare_amount,
+        "new_balance": from_cents(new_balance)
+    })
 
 @app.route('/topup_card', methods=['POST'])
 def topup_card():
-    data = request.json
+    data = load_json_body()
 
     if not data or 'uid' not in data or 'amount' not in data:
-        return jsonify({"error": "uid and amount are required"}), 400
+        return error_response(ERR_UID_AMOUNT_REQUIRED)
 
     card_id = data['uid']
     amount = float(data['amount'])
@@ -485,163 +1003,326 @@ def topup_card():
     if terminal_id:
         ensure_terminal_exists(terminal_id)
 
-    if not ensure_card_exists(card_id):
-        return jsonify({"error": "Card registration failed"}), 500
-
-    current_balance = get_card_balance(card_id)
+    conn, cursor = get_request_db()
+    if not conn:
+        return error_response(ERR_DB_CONNECTION, 500)
 
-    new_balance = current_balance + amount
-    if update_card_balance(card_id, new_balance):
-        record_transaction(
-            card_id, 
-            amount, 
-            current_balance,
-            new_balance,
-            "topup", 
-            terminal_id
-        )
-        
-        return jsonify({
-            "status": "success",
-            "uid": card_id,
-            "prior_balance": current_balance,
-            "topup_amount": amount,
-            "new_balance": new_balance
-        })
-    else:
+    try:
+        current_balance, new_balance = apply_card_transaction(conn, cursor, card_id, to_cents(amount), "topup", terminal_id)
+    except Error as e:
+        logger.error(f"Error in topup_card: {e}")
         return jsonify({"error": "Failed to process topup"}), 500
 
+    return jsonify({
+        "status": "success",
+        "uid": card_id,
+        "prior_balance": from_cents(current_balance),
+        "topup_amount": amount,
+        "new_balance": from_cents(new_balance)
+    })
+
 @app.route('/sync_transaction', methods=['POST'])
 def sync_transaction():
-    data = request.json
+    data = load_json_body()
 
     if not data or 'uid' not in data or 'amount' not in data:
-        return jsonify({"error": "uid and amount are required"}), 400
+        return error_response(ERR_UID_AMOUNT_REQUIRED)
         
     card_id = data['uid']
-    amount = float(data['amount'])
+    amount = to_cents(data['amount'])
     terminal_id = data.get('terminal_id')
     timestamp = data.get('timestamp')
-    balance_before = data.get('balance_before')
-    balance_after = data.get('balance_after')
+    balance_before = to_cents(data['balance_before']) if data.get('balance_before') is not None else None
+    balance_after = to_cents(data['balance_after']) if data.get('balance_after') is not None else None
     transaction_type = data.get('transaction_type', 'payment' if amount < 0 else 'topup')
+    client_tx_id = data.get('client_tx_id')
+
+    # replays after a network blip are acknowledged without any db work
+    if client_tx_id and is_seen_transaction(client_tx_id):
+        return jsonify({
+            "status": "duplicate",
+            "message": "Transaction already synced"
+        })
 
     if terminal_id:
         ensure_terminal_exists(terminal_id)
 
-    if not ensure_card_exists(card_id):
-        return jsonify({"error": "Card registration failed"}), 500
+    # terminals report both balances for offline transactions; those only need recording
+    if balance_before is not None and balance_after is not None:
+        if not ensure_card_exists(card_id):
+            return jsonify({"error": "Card registration failed"}), 500
 
-    if balance_before is None or balance_after is None:
-        current_balance = get_card_balance(card_id)
-        
-        if balance_before is None:
-            balance_before = current_balance - amount
-            
-        if balance_after is None:
-            balance_after = current_balance
-            
-        if not update_card_balance(card_id, balance_after):
-            logger.warning(f"Failed to update card balance during sync for {card_id}")
-
-    if record_transaction(
-        card_id, 
-        amount, 
-        balance_before,
-        balance_after,
-        transaction_type, 
-        terminal_id
-    ):
+        # the writer marks client_tx_id as seen once the row is committed
+        record_transaction(card_id, amount, balance_before, balance_after, transaction_type, terminal_id, client_tx_id)
         return jsonify({
             "status": "success",
             "message": "Transaction synced successfully"
         })
-    else:
+
+    conn, cursor = get_request_db()
+    if not conn:
+        return error_response(ERR_DB_CONNECTION, 500)
+
+    try:
+        synced = sync_card_transaction(conn, cursor, card_id, amount, balance_before, balance_after, transaction_type, terminal_id, client_tx_id)
+    except Error as e:
+        logger.error(f"Error in sync_transaction: {e}")
         return jsonify({"error": "Failed to sync transaction"}), 500
 
+    if client_tx_id:
+        remember_transaction(client_tx_id)
+
+    if not synced:
+        return jsonify({
+            "status": "duplicate",
+            "message": "Transaction already synced"
+        })
+
+    return jsonify({
+        "status": "success",
+        "message": "Transaction synced successfully"
+    })
+
+@app.route('/sync_transactions_batch', methods=['POST'])
+def sync_transactions_batch():
+    data = load_json_body()
+    items = data.get('transactions') if data else None
+
+    if not isinstance(items, list):
+        return error_response(ERR_TRANSACTIONS_REQUIRED)
+
+    conn, cursor = get_request_db()
+    if not conn:
+        return error_response(ERR_DB_CONNECTION, 500)
+
+    # one status per item, in request order
+    results = [None] * len(items)
+    rows = []
+    row_items = []
+    card_ids = set()
+    terminal_ids = set()
+    balance_syncs = []
+
+    for i, item in enumerate(items):
+        if not isinstance(item, dict) or 'uid' not in item or 'amount' not in item:
+            results[i] = "error"
+            continue
+
+        client_tx_id = item.get('client_tx_id')
+        if client_tx_id and is_seen_transaction(client_tx_id):
+            results[i] = "duplicate"
+            continue
+
+        try:
+            card_id = item['uid']
+            amount = to_cents(item['amount'])
+            balance_before = to_cents(item['balance_before']) if item.get('balance_before') is not None else None
+            balance_after = to_cents(item['balance_after']) if item.get('balance_after') is not None else None
+        except (TypeError, ValueError):
+            results[i] = "error"
+            continue
+
+        terminal_id = item.get('terminal_id')
+        transaction_type = item.get('transaction_type', 'payment' if amount < 0 else 'topup')
+        if terminal_id:
+            terminal_ids.add(terminal_id)
+
+        # rows with both balances are only recorded; the rest adjust the card like /sync_transaction
+        if balance_before is not None and balance_after is not None:
+            rows.append(transaction_row(card_id, amount, balance_before, balance_after, transaction_type, terminal_id, client_tx_id))
+            row_items.append((i, client_tx_id))
+            card_ids.add(card_id)
+        else:
+            balance_syncs.append((i, (card_id, amount, balance_before, balance_after, transaction_type, terminal_id, client_tx_id)))
+
+    for terminal_id in terminal_ids:
+        ensure_terminal_exists(terminal_id)
+
+    if rows:
+        # plain cursor: executemany() folds the rows into multi-row INSERTs, all in one commit
+        bulk_cursor = conn.cursor()
+        try:
+            bulk_cursor.executemany(INSERT_CARD_SQL, [(card_id, DEFAULT_BALANCE_CENTS) for card_id in card_ids])
+            bulk_cursor.executemany(INSERT_SYNCED_TRANSACTION_SQL, rows)
+            conn.commit()
+            status = "success"
+        except Error as e:
+            conn.rollback()
+            logger.error(f"Error in sync_transactions_batch: {e}")
+            status = "error"
+        finally:
+            bulk_cursor.close()
+
+        for i, client_tx_id in row_items:
+            results[i] = status
+            if client_tx_id and status == "success":
+                remember_transaction(client_tx_id)
+
+    for i, args in balance_syncs:
+        try:
+            synced = sync_card_transaction(conn, cursor, *args)
+        except Error as e:
+            logger.error(f"Error in sync_transactions_batch: {e}")
+            results[i] = "error"
+            continue
+
+        client_tx_id = args[-1]
+        if client_tx_id:
+            remember_transaction(client_tx_id)
+        results[i] = "success" if synced else "duplicate"
+
+    logger.info(f"Batch sync of {len(items)} transactions: {results.count('success')} recorded")
+    return jsonify({
+        "status": "success",
+        "results": results
+    })
+
+# encrypted columns, in the order they are decrypted
+TRANSACTION_CIPHER_FIELDS = ("amount", "balance_before", "balance_after", "transaction_type")
+# rows fetched, decrypted and written to the response per step
+TRANSACTIONS_FETCH_SIZE = 100
+
+def decode_transactions(rows):
+    # one decrypt pass over every encrypted field in the chunk (just a decode when encryption is off)
+    width = len(TRANSACTION_CIPHER_FIELDS)
+    values = decrypt_many([tx[field] for tx in rows for field in TRANSACTION_CIPHER_FIELDS])
+    for i, tx in enumerate(rows):
+        tx.update(zip(TRANSACTION_CIPHER_FIELDS, values[i * width:(i + 1) * width]))
+
+    # amounts are stored as cent strings; rows that failed to decrypt are returned as stored
+    for tx in rows:
+        try:
+            tx["amount"] = from_cents(int(tx["amount"]))
+            if tx["balance_before"]:
+                tx["balance_before"] = from_cents(int(tx["balance_before"]))
+            if tx["balance_after"]:
+                tx["balance_after"] = from_cents(int(tx["balance_after"]))
+        except Exception:
+            logger.error(f"Failed to decode transaction {tx['id']}")
+    return rows
+
+# page size cap for history requests; older rows are reached with ?before=
+TRANSACTIONS_MAX_LIMIT = 500
+
 @app.route('/get_transactions/<card_id>', methods=['GET'])
 def get_transactions(card_id):
+    # optional paging: ?limit=N&before=<iso timestamp> or ?before_id=<next_before_id of the last page>
+    limit = request.args.get('limit')
+    before = request.args.get('before')
+    before_id = request.args.get('before_id')
+
     try:
-        conn = get_db_connection()
-        if not conn:
-            logger.error("Could not connect to database")
-            return jsonify({"error": "Database connection failed"}), 500
+        limit = int(limit) if limit is not None else None
+        before = datetime.datetime.fromisoformat(before) if before else None
+        before_id = int(before_id) if before_id else None
+    except ValueError:
+        return jsonify({"error": "limit and before_id must be integers and before an ISO timestamp"}), 400
 
-        cursor = conn.cursor(dictionary=True)
-        
-        cursor.execute("""
+    if limit is not None and limit <= 0:
+        return jsonify({"error": "limit must be positive"}), 400
+
+    # bounded so the ix_tx_acct_ts_id range scan stops early even without a limit
+    limit = min(limit or TRANSACTIONS_MAX_LIMIT, TRANSACTIONS_MAX_LIMIT)
+
+    query = """
         SELECT id, account_id, amount, balance_before, balance_after, transaction_type, 
                terminal_id, timestamp 
         FROM transactions 
-        WHERE account_id = %s 
-        ORDER BY timestamp DESC
-        """, (card_id,))
-        
-        encrypted_transactions = cursor.fetchall()
-        
-        # decrypt transaction data
-        transactions = []
-        for tx in encrypted_transactions:
-            if ENCRYPTION_ENABLED:
-                try:
-                    decrypted_tx = {
-                        "id": tx["id"],
-                        "account_id": tx["account_id"],
-                        "amount": float(decrypt_data(tx["amount"])),
-                        "balance_before": float(decrypt_data(tx["balance_before"])) if tx["balance_before"] else None,
-                        "balance_after": float(decrypt_data(tx["balance_after"])) if tx["balance_after"] else None,
-                        "transaction_type": decrypt_data(tx["transaction_type"]),
-                        "terminal_id": tx["terminal_id"],
-                        "timestamp": tx["timestamp"]
-                    }
-                    transactions.append(decrypted_tx)
-                except Exception as e:
-                    logger.error(f"Failed to decrypt transaction: {e}")
-                    transactions.append(tx)  # use encrypted version if decryption fails
-            else:
-                # convert strings to numeric types without decryption
-                try:
-                    tx["amount"] = float(tx["amount"])
-                    if tx["balance_before"]:
-                        tx["balance_before"] = float(tx["balance_before"])
-                    if tx["balance_after"]:
-                        tx["balance_after"] = float(tx["balance_after"])
-                except Exception:
-                    pass
-                transactions.append(tx)
-        
-        return jsonify({
-            "status": "success",
-            "uid": card_id,
-            "transactions": transactions
-        })
+        WHERE account_id = %s"""
+    params = [card_id]
+
+    if before:
+        query += " AND timestamp < %s"
+        params.append(before)
+
+    conn = get_db_connection()
+    if not conn:
+        logger.error("Could not connect to database")
+        return error_response(ERR_DB_CONNECTION, 500)
+
+    try:
+        # the page key is (timestamp, id) of the last row on the previous page, matching the
+        # sort order so the scan continues down ix_tx_acct_ts_id
+        if before_id:
+            with closing(conn.cursor()) as key_cursor:
+                key_cursor.execute(
+                    "SELECT timestamp FROM transactions WHERE id = %s AND account_id = %s",
+                    (before_id, card_id)
+                )
+                key = fetch_single_row(key_cursor)
+            if key is None:
+                conn.close()
+                return jsonify({"error": "before_id is not a transaction of this card"}), 400
+            # (timestamp, id) < (key, before_id), spelled out so mysql can use it as an index range
+            query += " AND (timestamp < %s OR (timestamp = %s AND id < %s))"
+            params.extend((key[0], key[0], before_id))
+
+        query += " ORDER BY timestamp DESC, id DESC LIMIT %s"
+        params.append(limit)
+
+        # unbuffered: rows are streamed from mysql as the response is written
+        cursor = conn.cursor(dictionary=True, buffered=False)
+        cursor.execute(query, tuple(params))
     except Error as e:
         logger.error(f"Error in get_transactions: {e}")
+        conn.close()
         return jsonify({"error": "Failed to get transactions"}), 500
-    finally:
-        if conn and conn.is_connected():
-            cursor.close()
+
+    def generate():
+        try:
+            yield b'{"status":"success","uid":' + orjson.dumps(card_id) + b',"transactions":['
+            separator = b''
+            count = 0
+            last_id = None
+            while True:
+                rows = cursor.fetchmany(TRANSACTIONS_FETCH_SIZE)
+                if not rows:
+                    break
+                count += len(rows)
+                last_id = rows[-1]["id"]
+                yield separator + b','.join(orjson.dumps(tx, default=json_default) for tx in decode_transactions(rows))
+                separator = b','
+            # a full page may have more behind it; clients pass this back as before_id
+            next_before_id = last_id if count == limit else None
+            yield b'],"next_before_id":' + orjson.dumps(next_before_id) + b'}'
+        except Error as e:
+            logger.error(f"Error streaming transactions: {e}")
+        finally:
+            try:
+                # drain anything left if the client went away mid-stream
+                conn.consume_results()
+                cursor.close()
+            except Error:
+                pass
             conn.close()
 
+    return Response(generate(), mimetype='application/json')
+
 if __name__ == "__main__":
-    if not init_database():
+    if not init_database(reset="--reset" in sys.argv):
         logger.error("Failed to initialize database. Exiting.")
         sys.exit(1)
 
-    # check for ssl certificates
+    # check for ssl certificates, (re)generating them only when missing or near expiry
     cert_path = "certs/server.crt"
     key_path = "certs/server.key"
-    
+
+    try:
+        import certGeneration
+        certGeneration.create_cert()
+    except Exception as e:
+        logger.error(f"Could not generate certificates: {e}")
+
+    # prepare the schema and certs for a production server such as gunicorn, then stop
+    if "--init-only" in sys.argv:
+        sys.exit(0)
+
+    # requests are served on worker threads; set DEV=1 for the debugger and reloader
+    debug_mode = bool(os.getenv("DEV"))
+
     if os.path.exists(cert_path) and os.path.exists(key_path):
         logger.info("Starting secure server with HTTPS")
-        app.run(host='0.0.0.0', port=8443, ssl_context=(cert_path, key_path), debug=True)
+        app.run(host='0.0.0.0', port=8443, ssl_context=(cert_path, key_path), threaded=True, debug=debug_mode)
     else:
         logger.warning("SSL certificates not found, starting in plain HTTP mode (not secure)")
-        try:
-            import certGen
-            certGen.create_cert()
-            logger.info("Generated new certificates")
-            app.run(host='0.0.0.0', port=8443, ssl_context=(cert_path, key_path), debug=True)
-        except Exception as e:
-            logger.error(f"Could not generate certificates: {e}")
-            app.run(host='0.0.0.0', port=8080, debug=True)
+        app.run(host='0.0.0.0', port=8080, threaded=True, debug=debug_mode)
@@ -3,7 +3,10 @@ import sys
 import json
 import time
 import uuid
+import queue
 import base64
+import signal
+import itertools
 import hashlib
 import logging
 import sqlite3
@@ -11,26 +14,48 @@ import threading
 import datetime
 import requests
 import urllib3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from binascii import hexlify
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 # disable ssl warnings
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 print("NOTE: SSL certificate verification is disabled for development.")
 print("In production, proper certificates should be used.")
 
-# config settings
-ENCRYPTION_KEY_FILE = "terminal_key.key"
-SALT = b'bus_terminal_salt_value_123'  # change for prod
-SERVER_URL = "https://SERVER_IP:8443"  # use server ip
-TERMINAL_ID = str(uuid.uuid4())[:8]
-FARE_AMOUNT = 2.50
-DEFAULT_BALANCE = 50.00
-DB_FILE = "terminal.db"
-BALANCE_FILE = "balances.json"
+# config settings (read once at startup; environment variables override the defaults)
+ENCRYPTION_KEY_FILE = os.getenv("TERMINAL_KEY_FILE", "terminal_key.key")
+SERVER_URL = os.getenv("SERVER_URL", "https://SERVER_IP:8443")  # use server ip
+TERMINAL_ID = os.getenv("TERMINAL_ID") or str(uuid.uuid4())[:8]
+FARE_AMOUNT = float(os.getenv("FARE_AMOUNT", "2.50"))
+DEFAULT_BALANCE = float(os.getenv("DEFAULT_BALANCE", "50.00"))
+DB_FILE = os.getenv("TERMINAL_DB_FILE", "terminal.db")
+BALANCE_FILE = os.getenv("BALANCE_FILE", "balances.json")
+SYNC_BATCH_SIZE = 500
+SYNC_WORKERS = 4
+WRITE_BATCH_SIZE = 64
+WRITE_FLUSH_INTERVAL = 0.05
+WRITE_RETRY_INTERVAL = 1.0
+BALANCE_FLUSH_INTERVAL = 1.0
+# bcm pin wired to the pn532 irq line; unset polls the reader instead
+NFC_IRQ_PIN = int(os.environ["NFC_IRQ_PIN"]) if os.getenv("NFC_IRQ_PIN") else None
+nfc_irq = None
+NFC_RETRY_MIN = 0.02
+NFC_RETRY_MAX = 0.5
+NFC_RESET_AFTER = 3
+SYNC_INTERVAL = 300
+HEARTBEAT_INTERVAL = 60
 server_available = False
+# set to False to sync one transaction per request (servers without /sync_transactions_batch)
+batch_sync_enabled = True
 
 # logging setup
 logging.basicConfig(
@@ -43,27 +68,38 @@ logging.basicConfig(
 )
 logger = logging.getLogger('terminal')
 
+# one keep-alive session for every server call so the tls handshake is paid once
+# (Retry leaves POSTs alone on error statuses, so a payment is never sent twice).
+# connect and read failures aren't retried: a tap should fall back to offline mode after
+# one timeout, not several, and the reconnection manager takes it from there
+session = requests.Session()
+session.verify = False
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=SYNC_WORKERS,
+                                      max_retries=Retry(total=2, connect=0, read=0, backoff_factor=0.2,
+                                                        status_forcelist=[502, 503, 504])))
+
 # encryption setup
 def generate_encryption_key():
     if os.path.exists(ENCRYPTION_KEY_FILE):
         with open(ENCRYPTION_KEY_FILE, 'rb') as key_file:
             return key_file.read()
-    else:
-        password = f"{TERMINAL_ID}_secure_password".encode()  # change for prod
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=SALT,
-            iterations=100000,
-        )
-        key = base64.urlsafe_b64encode(kdf.derive(password))
-        with open(ENCRYPTION_KEY_FILE, 'wb') as key_file:
-            key_file.write(key)
-        return key
+
+    # random key readable only by this user; O_EXCL so two first starts can't both write one
+    key = base64.urlsafe_b64encode(os.urandom(32))
+    try:
+        fd = os.open(ENCRYPTION_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(ENCRYPTION_KEY_FILE, 'rb') as key_file:
+            return key_file.read()
+    with os.fdopen(fd, 'wb') as key_file:
+        key_file.write(key)
+    return key
 
 try:
     encryption_key = generate_encryption_key()
-    cipher = Fernet(encryption_key)
+    # aes-gcm on the raw 32-byte key; fernet is only kept to read data written before the switch
+    aead = AESGCM(base64.urlsafe_b64decode(encryption_key))
+    legacy_cipher = Fernet(encryption_key)
     ENCRYPTION_ENABLED = True
     print("Data encryption enabled")
 except Exception as e:
@@ -72,32 +108,58 @@ except Exception as e:
     ENCRYPTION_ENABLED = False
 
 # encryption functions
-def encrypt_data(data):
-    if not ENCRYPTION_ENABLED:
-        return data
-    if isinstance(data, (int, float)):
-        data = str(data)
-    if isinstance(data, str):
-        return cipher.encrypt(data.encode()).decode()
-    return data
+def encrypt_bytes(data):
+    # nonce + ciphertext + tag, stored as raw bytes where the column allows it
+    nonce = os.urandom(12)
+    return nonce + aead.encrypt(nonce, data, None)
+
+def decrypt_bytes(data):
+    try:
+        return aead.decrypt(data[:12], data[12:], None)
+    except InvalidTag:
+        # fernet tokens from before the switch
+        return legacy_cipher.decrypt(data)
+
+def encrypt_text(text):
+    return base64.b64encode(encrypt_bytes(text.encode())).decode()
 
 def decrypt_data(data):
     if not ENCRYPTION_ENABLED or data is None:
         return data
     if isinstance(data, str):
         try:
-            return cipher.decrypt(data.encode()).decode()
+            raw = base64.b64decode(data, validate=True)
+            return aead.decrypt(raw[:12], raw[12:], None).decode()
+        except (ValueError, InvalidTag):
+            pass
+        try:
+            # fernet tokens from before the switch
+            return legacy_cipher.decrypt(data.encode()).decode()
         except Exception:
             return data
     return data
 
+# values are tagged with their type before encryption ("f:2.5", "i:50", "s:text")
+# so decrypting doesn't have to guess
+VALUE_TAGS = {float: "f", int: "i", str: "s", bool: "s"}
+VALUE_TYPES = {"f": float, "i": int, "s": str}
+
+def decode_value(text):
+    if text[1:2] == ":" and text[0] in VALUE_TYPES:
+        return VALUE_TYPES[text[0]](text[2:])
+    # untagged values written before the tags existed
+    if text.replace('.', '', 1).isdigit():
+        return float(text) if '.' in text else int(text)
+    return text
+
 def encrypt_json(data):
     if not ENCRYPTION_ENABLED:
         return data
     encrypted_data = {}
     for key, value in data.items():
-        if isinstance(value, (str, int, float)):
-            encrypted_data[key] = encrypt_data(str(value))
+        tag = VALUE_TAGS.get(type(value))
+        if tag is not None:
+            encrypted_data[key] = encrypt_text(f"{tag}:{value}")
         elif isinstance(value, dict):
             encrypted_data[key] = encrypt_json(value)
         else:
@@ -111,14 +173,7 @@ def decrypt_json(data):
     for key, value in data.items():
         if isinstance(value, str):
             try:
-                decrypted_value = decrypt_data(value)
-                if decrypted_value.replace('.', '', 1).isdigit():
-                    if '.' in decrypted_value:
-                        decrypted_data[key] = float(decrypted_value)
-                    else:
-                        decrypted_data[key] = int(decrypted_value)
-                else:
-                    decrypted_data[key] = decrypted_value
+                decrypted_data[key] = decode_value(decrypt_data(value))
             except Exception:
                 decrypted_data[key] = value
         elif isinstance(value, dict):
@@ -127,38 +182,90 @@ def decrypt_json(data):
             decrypted_data[key] = value
     return decrypted_data
 
-# database functions
+# sensitive fields go into one encrypted json payload per row; the per-field
+# columns are only filled in rows written before the payload column existed
+TRANSACTIONS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        account_id TEXT NOT NULL,
+        amount TEXT,
+        balance_before TEXT,
+        balance_after TEXT,
+        transaction_type TEXT,
+        terminal_id TEXT NOT NULL,
+        timestamp TEXT,
+        synced INTEGER DEFAULT 0,
+        client_tx_id TEXT,
+        payload BLOB
+    )
+'''
+
+# database functions: one long-lived connection per thread (main loop, reconnection manager)
+_db_local = threading.local()
+
 def get_db_connection():
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE)
+        conn.row_factory = sqlite3.Row
+        # per-connection settings; wal itself is stored in the db file by init_database
+        conn.executescript("""
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA mmap_size=134217728;
+            PRAGMA cache_size=-20000;
+        """)
+        _db_local.conn = conn
     return conn
 
+# unsynced transactions, counted once at startup and kept up to date in memory
+# so the heartbeat doesn't query the database
+pending_count = 0
+pending_lock = threading.Lock()
+
+def add_pending(delta):
+    global pending_count
+    with pending_lock:
+        pending_count += delta
+
 def init_database():
+    global pending_count
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                account_id TEXT NOT NULL,
-                amount TEXT NOT NULL,
-                balance_before TEXT NOT NULL,
-                balance_after TEXT NOT NULL,
-                transaction_type TEXT NOT NULL,
-                terminal_id TEXT NOT NULL,
-                timestamp TEXT NOT NULL,
-                synced INTEGER DEFAULT 0
-            )
-        ''')
+        cursor.execute(TRANSACTIONS_TABLE_SQL.format(table="transactions"))
+        # databases created before client_tx_id existed
+        columns = [row["name"] for row in cursor.execute("PRAGMA table_info(transactions)")]
+        if "client_tx_id" not in columns:
+            cursor.execute("ALTER TABLE transactions ADD COLUMN client_tx_id TEXT")
+        # databases created before payload existed have NOT NULL per-field columns; rebuild the table
+        if "payload" not in columns:
+            cursor.executescript(f'''
+                BEGIN;
+                {TRANSACTIONS_TABLE_SQL.format(table="transactions_new")};
+                INSERT INTO transactions_new (
+                    id, account_id, amount, balance_before, balance_after,
+                    transaction_type, terminal_id, timestamp, synced, client_tx_id
+                )
+                SELECT id, account_id, amount, balance_before, balance_after,
+                       transaction_type, terminal_id, timestamp, synced, client_tx_id
+                FROM transactions;
+                DROP TABLE transactions;
+                ALTER TABLE transactions_new RENAME TO transactions;
+                COMMIT;
+            ''')
+            logger.info("Migrated transactions table to single-payload rows")
+        # pending rows only, so sync and heartbeat lookups cost O(pending)
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_tx_pending ON transactions(id) WHERE synced = 0")
+        # appends instead of rewriting pages on every commit; fewer fsyncs on the sd card
+        cursor.execute("PRAGMA journal_mode=WAL")
         conn.commit()
+        pending_count = cursor.execute("SELECT COUNT(*) FROM transactions WHERE synced = 0").fetchone()[0]
         logger.info("Database initialized")
         return True
     except Exception as e:
         logger.error(f"Database initialization error: {e}")
         return False
-    finally:
-        if 'conn' in locals() and conn:
-            conn.close()
 
 # nfc functions
 def init_nfc_reader():
@@ -175,28 +282,59 @@ def init_nfc_reader():
     ic, ver, rev, support = pn532.firmware_version
     logger.info(f"PN532 firmware version: {ver}.{rev}")
     pn532.SAM_configuration()
+
+    # the irq line goes low when the reader has a card for us, so we can sleep until then
+    global nfc_irq
+    if NFC_IRQ_PIN is not None:
+        from gpiozero import Button
+        nfc_irq = Button(NFC_IRQ_PIN, pull_up=True)
+        logger.info(f"Using PN532 IRQ on GPIO{NFC_IRQ_PIN}")
     return pn532
 
 def read_card_uid(pn532):
     logger.info("Waiting for card...")
     print("Tap a card when ready...")
+    listening = False
+    backoff = NFC_RETRY_MIN
+    failures = 0
     while True:
         try:
-            uid = pn532.read_passive_target(timeout=1.0)
+            if nfc_irq is not None:
+                if not listening:
+                    pn532.listen_for_passive_target()
+                    listening = True
+                if not nfc_irq.wait_for_press(timeout=1.0):
+                    continue
+                listening = False
+                uid = pn532.get_passive_target()
+            else:
+                uid = pn532.read_passive_target(timeout=1.0)
+            backoff = NFC_RETRY_MIN
+            failures = 0
             if uid is not None:
                 uid_hex = hexlify(uid).decode('utf-8').upper()
                 logger.info(f"Card UID: {uid_hex}")
                 return uid_hex
-            time.sleep(0.1)
         except Exception as e:
             logger.error(f"Card read error: {e}")
-            time.sleep(1)
+            listening = False
+            # short exponential backoff; a few failures in a row usually means the reader lost its state
+            time.sleep(backoff)
+            backoff = min(backoff * 2, NFC_RETRY_MAX)
+            failures += 1
+            if failures > NFC_RESET_AFTER:
+                failures = 0
+                try:
+                    pn532.SAM_configuration()
+                    logger.info("Reconfigured NFC reader after repeated read errors")
+                except Exception as e:
+                    logger.error(f"NFC reader reconfiguration failed: {e}")
 
 # server communication functions
 def check_server_connection():
     global server_available
     try:
-        response = requests.get(f"{SERVER_URL}/health", timeout=5, verify=False)
+        response = session.get(f"{SERVER_URL}/health", timeout=5)
         server_available = response.status_code == 200
         logger.info(f"Server connection: {'Connected' if server_available else 'Failed'}")
         return server_available
@@ -205,6 +343,13 @@ def check_server_connection():
         server_available = False
         return False
 
+def mark_server_down(error):
+    # the reconnection manager brings us back online; until then taps don't wait on the network
+    global server_available
+    if server_available:
+        logger.warning(f"Lost server connection, switching to offline mode: {error}")
+    server_available = False
+
 def reconnection_manager():
     global server_available
     while True:
@@ -220,63 +365,166 @@ def start_reconnection_manager():
     thread.start()
     logger.info("Reconnection manager thread started")
 
+def background_manager():
+    # periodic sync and heartbeat run here so a tap never waits on the network,
+    # and the network calls overlap with the main loop blocking on the nfc reader
+    last_sync_time = time.time()
+    last_heartbeat_time = time.time()
+    while True:
+        time.sleep(1)
+        current_time = time.time()
+
+        if current_time - last_sync_time >= SYNC_INTERVAL:
+            sync_transactions()
+            last_sync_time = current_time
+
+        if current_time - last_heartbeat_time >= HEARTBEAT_INTERVAL:
+            send_heartbeat()
+            last_heartbeat_time = current_time
+
+def start_background_manager():
+    thread = threading.Thread(target=background_manager, daemon=True)
+    thread.start()
+    logger.info("Background sync and heartbeat thread started")
+
+def sync_payload(tx):
+    if tx["payload"] is not None:
+        # one decrypt per row
+        payload = json.loads(decrypt_bytes(tx["payload"]) if ENCRYPTION_ENABLED else tx["payload"])
+        # taps store nanoseconds; the server still gets an iso timestamp (older rows already have one)
+        if isinstance(payload["timestamp"], int):
+            payload["timestamp"] = datetime.datetime.fromtimestamp(payload["timestamp"] / 1e9).isoformat()
+        payload.update({
+            "uid": tx["account_id"],
+            "terminal_id": TERMINAL_ID,
+            "client_tx_id": tx["client_tx_id"]
+        })
+        return payload
+
+    # rows written before the payload column: decrypt field by field
+    return {
+        "uid": tx["account_id"],
+        "amount": float(decrypt_data(tx["amount"])) if ENCRYPTION_ENABLED else float(tx["amount"]),
+        "balance_before": float(decrypt_data(tx["balance_before"])) if ENCRYPTION_ENABLED else float(tx["balance_before"]),
+        "balance_after": float(decrypt_data(tx["balance_after"])) if ENCRYPTION_ENABLED else float(tx["balance_after"]),
+        "transaction_type": decrypt_data(tx["transaction_type"]) if ENCRYPTION_ENABLED else tx["transaction_type"],
+        "terminal_id": TERMINAL_ID,
+        "timestamp": decrypt_data(tx["timestamp"]) if ENCRYPTION_ENABLED else tx["timestamp"],
+        "client_tx_id": tx["client_tx_id"]
+    }
+
+def sync_batch(tx_ids, payloads):
+    # returns the ids the server stored, or None if it has no batch endpoint
+    response = session.post(f"{SERVER_URL}/sync_transactions_batch",
+                            json={"terminal_id": TERMINAL_ID, "transactions": payloads},
+                            timeout=30)
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        logger.warning(f"Batch sync failed: {response.status_code}")
+        return []
+
+    results = response.json()["results"]
+    return [tx_id for tx_id, result in zip(tx_ids, results) if result in ("success", "duplicate")]
+
+def sync_one_by_one(tx_ids, payloads):
+    # one request per row, a few in flight at once (as many as the session keeps connections)
+    synced_ids = []
+    with ThreadPoolExecutor(max_workers=SYNC_WORKERS) as executor:
+        futures = {
+            executor.submit(session.post, f"{SERVER_URL}/sync_transaction", json=payload, timeout=5): tx_id
+            for tx_id, payload in zip(tx_ids, payloads)
+        }
+        for future in as_completed(futures):
+            tx_id = futures[future]
+            try:
+                response = future.result()
+                if response.status_code == 200:
+                    synced_ids.append(tx_id)
+                else:
+                    logger.warning(f"Sync failed for tx {tx_id}: {response.status_code}")
+            except Exception as e:
+                logger.error(f"Sync error for tx {tx_id}: {e}")
+    return synced_ids
+
+# the reconnection manager, the background manager and shutdown can all sync;
+# one at a time so the same rows aren't sent twice
+sync_lock = threading.Lock()
+
 def sync_transactions():
     if not server_available:
         logger.warning("Server unavailable, skipping sync")
         return False
 
+    with sync_lock:
+        return sync_pending_transactions()
+
+def sync_pending_transactions():
+    global batch_sync_enabled
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM transactions WHERE synced = 0")
-        transactions = cursor.fetchall()
-
-        if not transactions:
-            return True
-
+        # one page of SYNC_BATCH_SIZE rows is read, decrypted and posted at a time, so a long
+        # offline backlog never sits in memory at once; rows that fail are left for the next sync
+        last_id = 0
+        total_count = 0
         success_count = 0
-        for tx in transactions:
-            # decrypt transaction data for syncing
-            try:
-                payload = {
-                    "uid": tx["account_id"],
-                    "amount": float(decrypt_data(tx["amount"])) if ENCRYPTION_ENABLED else float(tx["amount"]),
-                    "balance_before": float(decrypt_data(tx["balance_before"])) if ENCRYPTION_ENABLED else float(tx["balance_before"]),
-                    "balance_after": float(decrypt_data(tx["balance_after"])) if ENCRYPTION_ENABLED else float(tx["balance_after"]),
-                    "transaction_type": decrypt_data(tx["transaction_type"]) if ENCRYPTION_ENABLED else tx["transaction_type"],
-                    "terminal_id": TERMINAL_ID,
-                    "timestamp": decrypt_data(tx["timestamp"]) if ENCRYPTION_ENABLED else tx["timestamp"]
-                }
-            except Exception as e:
-                logger.error(f"Failed to decrypt transaction {tx['id']}: {e}")
-                continue
-
-            try:
-                response = requests.post(f"{SERVER_URL}/sync_transaction", json=payload, timeout=5, verify=False)
-                if response.status_code == 200:
-                    cursor.execute("UPDATE transactions SET synced = 1 WHERE id = ?", (tx["id"],))
-                    conn.commit()
-                    success_count += 1
-                else:
-                    logger.warning(f"Sync failed for tx {tx['id']}: {response.status_code}")
-            except Exception as e:
-                logger.error(f"Sync error for tx {tx['id']}: {e}")
-
-        logger.info(f"Synced {success_count}/{len(transactions)} transactions")
-        return success_count == len(transactions)
+        while True:
+            cursor.execute(
+                "SELECT * FROM transactions WHERE synced = 0 AND id > ? ORDER BY id LIMIT ?",
+                (last_id, SYNC_BATCH_SIZE)
+            )
+            transactions = cursor.fetchall()
+            if not transactions:
+                break
+            last_id = transactions[-1]["id"]
+            total_count += len(transactions)
+
+            batch_ids = []
+            batch_payloads = []
+            for tx in transactions:
+                try:
+                    batch_payloads.append(sync_payload(tx))
+                    batch_ids.append(tx["id"])
+                except Exception as e:
+                    logger.error(f"Failed to decrypt transaction {tx['id']}: {e}")
+
+            synced_ids = None
+            if batch_sync_enabled:
+                try:
+                    synced_ids = sync_batch(batch_ids, batch_payloads)
+                except Exception as e:
+                    logger.error(f"Batch sync error: {e}")
+                    synced_ids = []
+                if synced_ids is None:
+                    logger.info("Server has no batch sync endpoint, syncing one transaction at a time")
+                    batch_sync_enabled = False
+            if synced_ids is None:
+                synced_ids = sync_one_by_one(batch_ids, batch_payloads)
+
+            # one statement and one commit per batch
+            cursor.executemany("UPDATE transactions SET synced = 1 WHERE id = ?", [(tx_id,) for tx_id in synced_ids])
+            conn.commit()
+            add_pending(-len(synced_ids))
+            success_count += len(synced_ids)
+
+        if total_count:
+            logger.info(f"Synced {success_count}/{total_count} transactions")
+        return success_count == total_count
     except Exception as e:
         logger.error(f"Sync process error: {e}")
-        return False
-    finally:
+        # the connection is reused, so don't leave a half-written batch open on it
         if 'conn' in locals() and conn:
-            conn.close()
+            conn.rollback()
+        return False
 
 # balance management functions
 def get_card_balances():
     if os.path.exists(BALANCE_FILE):
         try:
-            with open(BALANCE_FILE, 'r') as f:
-                encrypted_balances = json.load(f)
+            with open(BALANCE_FILE, 'rb') as f:
+                data = f.read()
+                encrypted_balances = orjson.loads(data) if orjson else json.loads(data)
                 if ENCRYPTION_ENABLED:
                     return decrypt_json(encrypted_balances)
                 return encrypted_balances
@@ -290,80 +538,193 @@ def save_card_balances(balances):
             encrypted_balances = encrypt_json(balances)
         else:
             encrypted_balances = balances
-            
-        with open(BALANCE_FILE, 'w') as f:
-            json.dump(encrypted_balances, f, indent=2)
+
+        if orjson:
+            data = orjson.dumps(encrypted_balances)
+        else:
+            data = json.dumps(encrypted_balances, separators=(",", ":")).encode()
+
+        # write and fsync a temp file, then swap it in, so a crash never leaves a half-written file
+        tmp_file = BALANCE_FILE + ".tmp"
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_file, BALANCE_FILE)
         return True
     except Exception as e:
         logger.error(f"Error saving balances: {e}")
         return False
 
+# balances live in memory; the file is loaded once and rewritten by balance_writer
+card_balances = None
+card_balances_lock = threading.Lock()
+card_balances_dirty = threading.Event()
+
+def load_card_balances():
+    global card_balances
+    with card_balances_lock:
+        if card_balances is None:
+            card_balances = get_card_balances()
+        return card_balances
+
+def set_card_balance(card_id, balance):
+    balances = load_card_balances()
+    with card_balances_lock:
+        balances[card_id] = balance
+    card_balances_dirty.set()
+
+def flush_card_balances():
+    balances = load_card_balances()
+    card_balances_dirty.clear()
+    with card_balances_lock:
+        snapshot = dict(balances)
+    if not save_card_balances(snapshot):
+        card_balances_dirty.set()
+        return False
+    return True
+
+def balance_writer():
+    while True:
+        card_balances_dirty.wait()
+        flush_card_balances()
+        time.sleep(BALANCE_FLUSH_INTERVAL)
+
+def start_balance_writer():
+    thread = threading.Thread(target=balance_writer, daemon=True)
+    thread.start()
+    logger.info("Balance writer thread started")
+
 def get_card_balance(card_id):
     if server_available:
         try:
-            response = requests.get(f"{SERVER_URL}/get_card_balance/{card_id}",
-                                    params={"terminal_id": TERMINAL_ID},
-                                    verify=False)
+            response = session.get(f"{SERVER_URL}/get_card_balance/{card_id}",
+                                   params={"terminal_id": TERMINAL_ID}, timeout=2)
             if response.status_code == 200:
                 balance = response.json()["balance"]
-                balances = get_card_balances()
-                balances[card_id] = balance
-                save_card_balances(balances)
+                set_card_balance(card_id, balance)
                 return balance
+        except requests.exceptions.RequestException as e:
+            mark_server_down(e)
         except Exception as e:
             logger.error(f"Balance fetch error: {e}")
 
     # fallback to local storage
-    balances = get_card_balances()
-    if card_id in balances:
-        return balances[card_id]
-    else:
-        balances[card_id] = DEFAULT_BALANCE
-        save_card_balances(balances)
-        logger.info(f"Assigned default balance for new card {card_id}")
-        return DEFAULT_BALANCE
+    balances = load_card_balances()
+    with card_balances_lock:
+        balance = balances.get(card_id)
+    if balance is not None:
+        return balance
+
+    set_card_balance(card_id, DEFAULT_BALANCE)
+    logger.info(f"Assigned default balance for new card {card_id}")
+    return DEFAULT_BALANCE
 
 def update_card_balance(card_id, new_balance):
-    balances = get_card_balances()
-    balances[card_id] = new_balance
-    if save_card_balances(balances):
-        logger.info(f"Updated balance for {card_id}: ${new_balance}")
-        return True
-    return False
+    set_card_balance(card_id, new_balance)
+    logger.info(f"Updated balance for {card_id}: ${new_balance}")
+    return True
 
 # transaction functions
-def register_transaction(card_id, amount, before, after):
-    timestamp = datetime.datetime.now().isoformat()
-    tx_type = "payment" if amount < 0 else "topup"
-    
+INSERT_TRANSACTION_SQL = """
+    INSERT INTO transactions (account_id, terminal_id, synced, client_tx_id, payload)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+# local writes are queued as (sql, params) and committed in batches by transaction_writer,
+# so a tap never waits on an sd card fsync
+write_queue = queue.Queue()
+transaction_writer_thread = None
+
+def write_batch(items):
+    conn = get_db_connection()
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # encrypt sensitive data if encryption is enabled
-        amount_val = encrypt_data(str(amount)) if ENCRYPTION_ENABLED else str(amount)
-        before_val = encrypt_data(str(before)) if ENCRYPTION_ENABLED else str(before)
-        after_val = encrypt_data(str(after)) if ENCRYPTION_ENABLED else str(after)
-        tx_type_val = encrypt_data(tx_type) if ENCRYPTION_ENABLED else tx_type
-        timestamp_val = encrypt_data(timestamp) if ENCRYPTION_ENABLED else timestamp
-        
-        cursor.execute("""
-            INSERT INTO transactions (
-                account_id, amount, balance_before, balance_after,
-                transaction_type, terminal_id, timestamp, synced
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (card_id, amount_val, before_val, after_val, tx_type_val, TERMINAL_ID, timestamp_val, 0))
-        
+        # consecutive statements of the same kind go in one executemany, all in one commit
+        for sql, group in itertools.groupby(items, key=lambda item: item[0]):
+            conn.executemany(sql, [params for _, params in group])
         conn.commit()
+    except Exception as e:
+        logger.error(f"Failed to write {len(items)} queued transaction changes: {e}")
+        try:
+            conn.rollback()
+        except sqlite3.Error:
+            pass
+        return False
+
+    # rows only count as pending once they are on disk
+    add_pending(sum(1 for sql, params in items if sql == INSERT_TRANSACTION_SQL and not params[2]))
+    return True
+
+def transaction_writer():
+    while True:
+        items = [write_queue.get()]
+        deadline = time.time() + WRITE_FLUSH_INTERVAL
+
+        while len(items) < WRITE_BATCH_SIZE:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(write_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        # the balances are already debited, so keep retrying rather than drop the taps
+        while not write_batch(items):
+            time.sleep(WRITE_RETRY_INTERVAL)
+        for _ in items:
+            write_queue.task_done()
+
+def start_transaction_writer():
+    global transaction_writer_thread
+    transaction_writer_thread = threading.Thread(target=transaction_writer, daemon=True)
+    transaction_writer_thread.start()
+    logger.info("Transaction writer thread started")
+
+def flush_transaction_writes():
+    if transaction_writer_thread is not None:
+        write_queue.join()
+        return
+
+    items = []
+    while True:
+        try:
+            items.append(write_queue.get_nowait())
+        except queue.Empty:
+            break
+    if items and not write_batch(items):
+        for item in items:
+            write_queue.put(item)
+
+def register_transaction(card_id, amount, before, after, synced=0):
+    # formatted at sync time, off the tap path
+    timestamp = time.time_ns()
+    tx_type = "payment" if amount < 0 else "topup"
+    # lets the server drop replays of a transaction it has already synced
+    client_tx_id = uuid.uuid4().hex
+
+    try:
+        # sensitive fields are encrypted together as one json payload
+        payload = json.dumps({
+            "amount": amount,
+            "balance_before": before,
+            "balance_after": after,
+            "transaction_type": tx_type,
+            "timestamp": timestamp
+        }).encode()
+        if ENCRYPTION_ENABLED:
+            payload = encrypt_bytes(payload)
+
+        write_queue.put((INSERT_TRANSACTION_SQL, (card_id, TERMINAL_ID, synced, client_tx_id, payload)))
         logger.info(f"Transaction recorded: {card_id}, ${amount}")
-        return True
+        return client_tx_id
     except Exception as e:
         logger.error(f"Register transaction error: {e}")
-        return False
-    finally:
-        if 'conn' in locals() and conn:
-            conn.close()
+        return None
 
 def process_fare_payment(card_id):
     current_balance = get_card_balance(card_id)
@@ -381,7 +742,7 @@ def process_fare_payment(card_id):
                 "fare": FARE_AMOUNT,
                 "terminal_id": TERMINAL_ID
             }
-            response = requests.post(f"{SERVER_URL}/process_payment", json=payload, timeout=5, verify=False)
+            response = session.post(f"{SERVER_URL}/process_payment", json=payload, timeout=5)
             if response.status_code == 200:
                 new_balance = response.json()["new_balance"]
                 server_synced = True
@@ -389,6 +750,9 @@ def process_fare_payment(card_id):
             else:
                 logger.warning(f"Server returned error: {response.status_code}")
                 print("Processing payment in offline mode")
+        except requests.exceptions.RequestException as e:
+            mark_server_down(e)
+            print("Processing payment in offline mode")
         except Exception as e:
             logger.error(f"Payment server error: {e}")
             print("Processing payment in offline mode")
@@ -396,22 +760,8 @@ def process_fare_payment(card_id):
         print("Processing payment in offline mode")
 
     if update_card_balance(card_id, new_balance):
-        register_transaction(card_id, -FARE_AMOUNT, current_balance, new_balance)
-        if server_synced:
-            try:
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute("""
-                    UPDATE transactions SET synced = 1
-                    WHERE account_id = ? AND amount = ?
-                    ORDER BY timestamp DESC LIMIT 1
-                """, (card_id, encrypt_data(str(-FARE_AMOUNT)) if ENCRYPTION_ENABLED else str(-FARE_AMOUNT)))
-                conn.commit()
-            except Exception as e:
-                logger.error(f"Failed to update sync status: {e}")
-            finally:
-                if 'conn' in locals() and conn:
-                    conn.close()
+        # transactions the server already applied are stored as synced
+        register_transaction(card_id, -FARE_AMOUNT, current_balance, new_balance, synced=int(server_synced))
         return True
     return False
 
@@ -431,7 +781,7 @@ def process_topup(card_id, amount):
                 "amount": amount,
                 "terminal_id": TERMINAL_ID
             }
-            response = requests.post(f"{SERVER_URL}/topup_card", json=payload, timeout=5, verify=False)
+            response = session.post(f"{SERVER_URL}/topup_card", json=payload, timeout=5)
             if response.status_code == 200:
                 new_balance = response.json()["new_balance"]
                 server_synced = True
@@ -439,6 +789,9 @@ def process_topup(card_id, amount):
             else:
                 logger.warning(f"Server returned error: {response.status_code}")
                 print("Processing topup in offline mode")
+        except requests.exceptions.RequestException as e:
+            mark_server_down(e)
+            print("Processing topup in offline mode")
         except Exception as e:
             logger.error(f"Topup server error: {e}")
             print("Processing topup in offline mode")
@@ -446,22 +799,7 @@ def process_topup(card_id, amount):
         print("Processing topup in offline mode")
 
     if update_card_balance(card_id, new_balance):
-        register_transaction(card_id, amount, current_balance, new_balance)
-        if server_synced:
-            try:
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute("""
-                    UPDATE transactions SET synced = 1
-                    WHERE account_id = ? AND amount = ?
-                    ORDER BY timestamp DESC LIMIT 1
-                """, (card_id, encrypt_data(str(amount)) if ENCRYPTION_ENABLED else str(amount)))
-                conn.commit()
-            except Exception as e:
-                logger.error(f"Failed to update sync status: {e}")
-            finally:
-                if 'conn' in locals() and conn:
-                    conn.close()
+        register_transaction(card_id, amount, current_balance, new_balance, synced=int(server_synced))
         return True
     return False
 
@@ -471,12 +809,6 @@ def send_heartbeat():
         return False
 
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM transactions WHERE synced = 0")
-        pending_count = cursor.fetchone()[0]
-        conn.close()
-
         payload = {
             "terminal_id": TERMINAL_ID,
             "pending_transactions": pending_count,
@@ -484,9 +816,12 @@ def send_heartbeat():
             "local_time": int(time.time())
         }
 
-        response = requests.post(f"{SERVER_URL}/terminal_heartbeat", json=payload, timeout=2, verify=False)
+        response = session.post(f"{SERVER_URL}/terminal_heartbeat", json=payload, timeout=2)
         return response.status_code == 200
 
+    except requests.exceptions.RequestException as e:
+        mark_server_down(e)
+        return False
     except Exception as e:
         logger.debug(f"Failed to send heartbeat: {e}")
         return False
@@ -515,30 +850,23 @@ def main():
         logger.error(f"NFC init failed: {e}")
         return
 
+    # turn SIGTERM into a normal exit so the finally block below flushes queued writes
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    load_card_balances()
+    start_balance_writer()
+    start_transaction_writer()
     check_server_connection()
     start_reconnection_manager()
     sync_transactions()
+    start_background_manager()
 
     print(f"\nTerminal Ready")
     print(f"Server status: {'ONLINE' if server_available else 'OFFLINE'}")
     print(f"Tap card to pay ${FARE_AMOUNT:.2f}")
 
     try:
-        last_sync_time = time.time()
-        last_heartbeat_time = time.time()
-
         while True:
-            current_time = time.time()
-
-            # background tasks
-            if current_time - last_sync_time >= 300:
-                if sync_transactions():
-                    last_sync_time = current_time
-
-            if current_time - last_heartbeat_time >= 60:
-                if send_heartbeat():
-                    last_heartbeat_time = current_time
-
             # card reading
             card_id = read_card_uid(pn532)
 
@@ -562,6 +890,8 @@ def main():
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
     finally:
+        flush_card_balances()
+        flush_transaction_writes()
         sync_transactions()
 
 if __name__ == "__main__":